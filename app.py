@@ -5,39 +5,119 @@ from flask import (Flask,
                    url_for,
                    flash,
                    send_file,
-                   make_response)
+                   make_response,
+                   g,
+                   has_request_context)
 from flask_restful import Api, Resource, abort
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy.exc import SQLAlchemyError
+from flask_sqlalchemy.session import Session
+from sqlalchemy.exc import SQLAlchemyError, OperationalError
 from sqlalchemy import func
+from sqlalchemy.dialects.postgresql import insert
 from flask_migrate import Migrate
-from sqlalchemy.orm import make_transient
+from sqlalchemy.orm import make_transient, aliased
 from werkzeug.utils import secure_filename
-from datetime import datetime
+from datetime import datetime, timedelta
+from functools import wraps
 from hashlib import sha256, sha1
 import zlib
 import zipfile
 import mimetypes
 import secrets
+import random
+import time
 from math import ceil
+import re
 import sys
 import io
 
+import click
+
 import constants
 
 app = Flask(__name__)
 api = Api(app)
 app.config['SECRET_KEY'] = constants.SECRET_KEY
-app.config['SQLALCHEMY_DATABASE_URI'] = \
-    f'postgresql+psycopg2://{constants.DATABASE_USER}:'\
-    f'{constants.DATABASE_PASSWORD}@'\
-    f'{constants.DATABASE_HOST}/' \
-    f'{constants.DATABASE_NAME}'
+
+
+def database_uri(host):
+    return f'postgresql+psycopg2://{constants.DATABASE_USER}:'\
+           f'{constants.DATABASE_PASSWORD}@'\
+           f'{host}/' \
+           f'{constants.DATABASE_NAME}'
+
+
+app.config['SQLALCHEMY_DATABASE_URI'] = database_uri(constants.DATABASE_HOST)
+app.config['SQLALCHEMY_BINDS'] = {
+    f'replica_{i}': {
+        'url': database_uri(host),
+        'connect_args': {'connect_timeout': getattr(
+            constants, 'DATABASE_REPLICA_CONNECT_TIMEOUT', 2)}}
+    for i, host in enumerate(
+        getattr(constants, 'DATABASE_REPLICA_HOSTS', ()))}
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    'pool_size': getattr(constants, 'DATABASE_POOL_SIZE', 5),
+    'max_overflow': getattr(constants, 'DATABASE_MAX_OVERFLOW', 10),
+    'pool_recycle': getattr(constants, 'DATABASE_POOL_RECYCLE', -1),
+    'pool_pre_ping': getattr(constants, 'DATABASE_POOL_PRE_PING', False)}
+PRIMARY_STICKINESS_SECONDS = getattr(constants,
+                                     'PRIMARY_STICKINESS_SECONDS', 5)
+REPLICA_COOLDOWN_SECONDS = getattr(constants,
+                                   'REPLICA_COOLDOWN_SECONDS', 30)
+SEARCH_TERM_LENGTH = getattr(constants, 'SEARCH_TERM_LENGTH', 32)
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-db = SQLAlchemy(app)
+
+
+class RoutingSession(Session):
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing \
+                and has_request_context() and g.get('replica'):
+            return replica_engines()[g.replica]
+        return super().get_bind(mapper, clause=clause, bind=bind, **kwargs)
+
+
+db = SQLAlchemy(app, session_options={'class_': RoutingSession})
 migrate = Migrate(app, db)
 
 
+replica_down_until = {}
+
+
+def replica_engines():
+    return {key: engine for key, engine in db.engines.items()
+            if key is not None}
+
+
+def recently_written(token):
+    t = db.session.query(Token.last_write_at)\
+        .filter_by(token_hash=generate_token_hash(token)).first()
+    if t is None:
+        return True
+    return t.last_write_at is not None and \
+        datetime.now() - t.last_write_at < \
+        timedelta(seconds=PRIMARY_STICKINESS_SECONDS)
+
+
+def read_only(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        replicas = [key for key in replica_engines()
+                    if replica_down_until.get(key, 0) <= time.monotonic()]
+        if request.method not in ('GET', 'HEAD') or not replicas \
+                or recently_written(kwargs['token']):
+            return view(*args, **kwargs)
+        g.replica = random.choice(replicas)
+        try:
+            return view(*args, **kwargs)
+        except OperationalError:
+            db.session.rollback()
+            replica_down_until[g.replica] = \
+                time.monotonic() + REPLICA_COOLDOWN_SECONDS
+            g.replica = None
+            return view(*args, **kwargs)
+    return wrapper
+
+
 def generate_user_token(n):
     return secrets.token_urlsafe(n)
 
@@ -96,6 +176,88 @@ def generate_zip(file_list):
         return zip_bytes
 
 
+def is_text_file(filename):
+    mimetype = mimetypes.guess_type(filename)[0]
+    return bool(mimetype) and mimetype.startswith('text')
+
+
+def tokenize(text):
+    return set(re.findall(r'\w+', text.lower()))
+
+
+def index_terms(words):
+    return {word[:SEARCH_TERM_LENGTH] for word in words}
+
+
+def index_blobs(file_list):
+    indexed = set()
+    for file in sorted(file_list, key=lambda file: file.hash):
+        if file.hash in indexed or not is_text_file(file.filename):
+            continue
+        indexed.add(file.hash)
+        if BlobTerm.query.filter_by(blob_hash=file.hash)\
+                .order_by(BlobTerm.term)\
+                .with_for_update(read=True).first():
+            continue
+        try:
+            text = zlib.decompress(file.data).decode('utf-8')
+        except UnicodeDecodeError:
+            continue
+        terms = index_terms(tokenize(text))
+        if terms:
+            db.session.execute(insert(BlobTerm).values(
+                [{'term': term, 'blob_hash': file.hash} for term in terms])
+                .on_conflict_do_nothing())
+
+
+def prune_blob_terms(blob_hashes):
+    db.session.flush()
+    db.session.query(BlobTerm.blob_hash)\
+        .filter(BlobTerm.blob_hash.in_(blob_hashes))\
+        .order_by(BlobTerm.blob_hash, BlobTerm.term)\
+        .with_for_update().all()
+    referenced = db.session.query(File.hash)\
+        .filter(File.hash.in_(blob_hashes))
+    BlobTerm.query\
+        .filter(BlobTerm.blob_hash.in_(blob_hashes))\
+        .filter(BlobTerm.blob_hash.notin_(referenced))\
+        .delete(synchronize_session=False)
+
+
+def search_filelist(t, words, commit=None):
+    terms = index_terms(words)
+    blob_hashes = db.session.query(BlobTerm.blob_hash)\
+        .filter(BlobTerm.term.in_(terms))\
+        .group_by(BlobTerm.blob_hash)\
+        .having(func.count(BlobTerm.term) == len(terms))
+    newer_file = aliased(File)
+    newer_commit = aliased(Commit)
+    superseded = db.session.query(newer_file.id)\
+        .join(newer_commit, newer_file.commit_id == newer_commit.id)\
+        .filter(newer_commit.token_id == t.id)\
+        .filter(newer_file.filename == File.filename)\
+        .filter(newer_file.id > File.id)
+    c = db.session.query(File.filename, Commit.hash, File.data)\
+        .join(Commit).filter_by(token=t)\
+        .filter(File.hash.in_(blob_hashes))
+    if commit:
+        created_at = db.session.query(Commit.created_at).filter_by(
+            token=t).filter(Commit.hash.like(f'{commit}%')).first()
+        if not created_at:
+            return None
+        superseded = superseded\
+            .filter(newer_commit.created_at <= created_at.created_at)
+        c = c.filter(Commit.created_at <= created_at.created_at)
+    return c.filter(~superseded.exists())\
+        .order_by(File.filename).all()
+
+
+def search_lines(text, words):
+    return [{'line': number, 'text': line}
+            for number, line in enumerate(text.split('\n'), start=1)
+            if tokenize(line) & words]
+
+
 def generate_token():
     token = generate_user_token(constants.TOKEN_BYTES_LENGTH)
     token_hash = generate_token_hash(token)
@@ -160,6 +322,8 @@ def delete_commit(token_object, commit):
                 child_file.parent_id = file.parent_id
             db.session.delete(file)
         db.session.delete(commit_to_delete)
+        prune_blob_terms({file.hash for file in files_to_delete})
+        token_object.last_write_at = datetime.now()
     except SQLAlchemyError:
         db.session.rollback()
         return False
@@ -170,11 +334,14 @@ def delete_commit(token_object, commit):
 
 def delete_token(token_object):
     commit_object = Commit.query.filter_by(token=token_object).all()
+    blob_hashes = {file.hash for file in db.session.query(File.hash)
+                   .join(Commit).filter_by(token=token_object)}
     try:
         for commit in commit_object:
             File.query.filter_by(commit=commit).delete()
             db.session.delete(commit)
         db.session.delete(token_object)
+        prune_blob_terms(blob_hashes)
     except SQLAlchemyError as exc:
         print(exc)
         db.session.rollback()
@@ -198,6 +365,8 @@ class Token(db.Model):
                               lazy=True)
     current_size = db.Column(db.BigInteger,
                              default=0)
+    last_write_at = db.Column(db.DateTime,
+                              default=datetime.now)
 
     def __repr__(self):
         return f'Token {self.__dict__}'
@@ -228,16 +397,29 @@ class File(db.Model):
                           db.ForeignKey('commit.id'),
                           nullable=False)
     filename = db.Column(db.String(128),
-                         nullable=False)
+                         nullable=False,
+                         index=True)
     data = db.Column(db.LargeBinary,
                      nullable=False)
-    hash = db.Column(db.String(40))
+    hash = db.Column(db.String(40),
+                     index=True)
     parent_id = db.Column(db.Integer)
 
     def __repr__(self):
         return f'File {" ".join([str(self.__dict__[key]) for key in self.__dict__.keys() if key != "data"])}'
 
 
+class BlobTerm(db.Model):
+    term = db.Column(db.String(SEARCH_TERM_LENGTH),
+                     primary_key=True)
+    blob_hash = db.Column(db.String(40),
+                          primary_key=True,
+                          index=True)
+
+    def __repr__(self):
+        return f'BlobTerm {self.term} {self.blob_hash}'
+
+
 @app.route('/')
 def index():
     if request.args.get('token', None):
@@ -271,6 +453,7 @@ def bare_checkout(token):
 
 
 @app.route('/<token>/commits/<commit>', methods=['GET', 'POST'])
+@read_only
 def checkout(token, commit):
     t = abort_if_token_nonexistent(token)
     if request.method == 'POST':
@@ -309,6 +492,7 @@ def checkout(token, commit):
 
 
 @app.route('/<token>/commits/<commit>/changes/<filename>')
+@read_only
 def changes(token, commit, filename):
     t = abort_if_token_nonexistent(token)
     if not mimetypes.guess_type(filename)[0].startswith('text'):
@@ -383,6 +567,7 @@ def list_commits(token):
 
 
 @app.route('/<token>/commits/<commit>/<filename>')
+@read_only
 def file_preview(token, commit, filename):
     t = abort_if_token_nonexistent(token)
 
@@ -400,6 +585,21 @@ def file_preview(token, commit, filename):
     return send_file(io.BytesIO(data), mimetype=mimetype)
 
 
+@app.cli.command('index-files')
+@click.option('--batch-size', default=100)
+def index_files(batch_size):
+    last_id = 0
+    while True:
+        batch = File.query.filter(File.id > last_id)\
+            .order_by(File.id).limit(batch_size).all()
+        if not batch:
+            break
+        index_blobs(batch)
+        db.session.commit()
+        last_id = batch[-1].id
+        click.echo(f'Indexed files up to id {last_id}')
+
+
 @app.errorhandler(404)
 def not_found(exc):
     return make_response('Not found!', 404)
@@ -470,7 +670,9 @@ class ApiCommit(Resource):
                                         " commits to proceed"}, 409)
             else:
                 db.session.add_all(file_list)
+                index_blobs(file_list)
                 t.current_size = new_size
+                t.last_write_at = datetime.now()
                 response = ({"message": "OK"}, 201)
         finally:
             db.session.commit()
@@ -478,6 +680,8 @@ class ApiCommit(Resource):
 
 
 class ApiList(Resource):
+    method_decorators = [read_only]
+
     def get(self, token):
         t = abort_if_token_nonexistent(token)
         filelist = Commit.query.filter_by(token=t).all()
@@ -494,6 +698,8 @@ class ApiList(Resource):
 
 
 class ApiPull(Resource):
+    method_decorators = [read_only]
+
     def get(self, token):
         t = abort_if_token_nonexistent(token)
         filelist = pull_filelist(t)
@@ -506,6 +712,8 @@ class ApiPull(Resource):
 
 
 class ApiCheckout(Resource):
+    method_decorators = [read_only]
+
     def get(self, token, commit):
         t = abort_if_token_nonexistent(token)
         filelist = checkout_filelist(t, commit)
@@ -519,6 +727,28 @@ class ApiCheckout(Resource):
                                        f'.zip')
 
 
+class ApiSearch(Resource):
+    method_decorators = [read_only]
+
+    def get(self, token):
+        t = abort_if_token_nonexistent(token)
+        words = tokenize(request.args.get('q', ''))
+        if not words:
+            abort(400, message='No search terms provided')
+        commit = request.args.get('commit', None)
+        filelist = search_filelist(t, words, commit)
+        if filelist is None:
+            abort(404, message='Commit not found')
+        response_json = {}
+        for filename, commit_hash, data in filelist:
+            text = zlib.decompress(data).decode('utf-8')
+            if not words <= tokenize(text):
+                continue
+            response_json[filename] = {'commit': commit_hash,
+                                       'lines': search_lines(text, words)}
+        return response_json, 200
+
+
 class ApiDelete(Resource):
     def delete(self, token, commit):
         t = abort_if_token_nonexistent(token)
@@ -552,6 +782,9 @@ api.add_resource(ApiPull,
 api.add_resource(ApiCheckout,
                  "/api/<string:token>/checkout/<string:commit>",
                  endpoint='api.checkout')
+api.add_resource(ApiSearch,
+                 "/api/<string:token>/search",
+                 endpoint='api.search')
 api.add_resource(ApiDelete,
                  "/api/<string:token>/delete/<string:commit>",
                  endpoint='api.delete')
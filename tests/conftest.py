@@ -1,4 +1,6 @@
 import pytest
+from sqlalchemy import create_engine, event
+import app as geethub
 from app import app as geethub_app
 
 
@@ -10,3 +12,19 @@ def app():
 @pytest.fixture()
 def client(app):
     return app.test_client()
+
+
+@pytest.fixture()
+def replica(app, monkeypatch):
+    engine = create_engine(app.config['SQLALCHEMY_DATABASE_URI'])
+    statements = []
+
+    def record(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(engine, 'before_cursor_execute', record)
+    monkeypatch.setattr(geethub, 'replica_engines',
+                        lambda: {'replica_0': engine})
+    monkeypatch.setattr(geethub, 'replica_down_until', {})
+    yield statements
+    engine.dispose()
@@ -1,9 +1,12 @@
 from werkzeug.datastructures import FileStorage
 from flask import url_for
 from copy import copy
+from hashlib import sha1
 import io
 
-from app import generate_token, generate_user_token
+from app import (generate_token, generate_user_token,
+                 tokenize, index_terms, BlobTerm,
+                 recently_written, SEARCH_TERM_LENGTH)
 
 t, token = generate_token()
 commit = None
@@ -65,6 +68,90 @@ def test_commit(client):
         assert apply_changes_response == 201
 
 
+def test_search(client):
+    fine_response = client.get(url_for('api.search', token=token),
+                               query_string={'q': 'abcdefg'})
+    no_terms_response = client.get(url_for('api.search', token=token),
+                                   query_string={'q': ''})
+    missing_response = client.get(url_for('api.search', token=token),
+                                  query_string={'q': 'hijklmn'})
+    assert fine_response.status_code == 200\
+           and list(fine_response.json.keys()) == ['file1.txt']\
+           and fine_response.json['file1.txt']['lines'][0]['line'] == 1
+    assert no_terms_response.status_code == 400
+    assert missing_response.status_code == 200\
+           and not missing_response.json
+
+
+def test_search_history(client):
+    search_t, search_token = generate_token()
+    long_word = 'long_' + 'a' * SEARCH_TERM_LENGTH
+    shared = f'shared line\n{long_word}b'.encode()
+    first_response = client.post(url_for('api.commit',
+                                         token=search_token), data={
+        'message': 'first commit',
+        'file1': FileStorage(stream=io.BytesIO(
+            f'hello world\n{long_word}'.encode()), filename='file1.txt'),
+        'file2': FileStorage(stream=io.BytesIO(shared),
+                             filename='file2.txt'),
+        'file3': FileStorage(stream=io.BytesIO(shared),
+                             filename='file3.txt')
+    }, content_type='multipart/form-data')
+    second_response = client.post(url_for('api.commit',
+                                          token=search_token), data={
+        'message': 'second commit',
+        'file1': FileStorage(stream=io.BytesIO(b'abcdefg'),
+                             filename='file1.txt')
+    }, content_type='multipart/form-data')
+    list_response = client.get(url_for('api.list', token=search_token))
+    first_commit = [key for key, value in list_response.json.items()
+                    if key != 'current_size'
+                    and value['message'] == 'first commit'][0]
+
+    head_response = client.get(url_for('api.search', token=search_token),
+                               query_string={'q': 'abcdefg'})
+    old_head_response = client.get(url_for('api.search',
+                                           token=search_token),
+                                   query_string={'q': 'hello'})
+    scoped_response = client.get(url_for('api.search', token=search_token),
+                                 query_string={'q': 'hello world',
+                                               'commit': first_commit})
+    scoped_new_response = client.get(url_for('api.search',
+                                             token=search_token),
+                                     query_string={'q': 'abcdefg',
+                                                   'commit': first_commit})
+    long_response = client.get(url_for('api.search', token=search_token),
+                               query_string={'q': long_word,
+                                             'commit': first_commit})
+    long_mixed_response = client.get(url_for('api.search',
+                                             token=search_token),
+                                     query_string={'q': f'shared {long_word}'})
+    unknown_commit_response = client.get(url_for('api.search',
+                                                 token=search_token),
+                                         query_string={'q': 'hello',
+                                                       'commit': 'zzzzzz'})
+    shared_hash = sha1(shared).hexdigest()
+
+    assert first_response.status_code == 201
+    assert second_response.status_code == 201
+    assert list(head_response.json.keys()) == ['file1.txt']
+    assert not old_head_response.json
+    assert list(scoped_response.json.keys()) == ['file1.txt']\
+           and scoped_response.json['file1.txt']['lines'][0]['line'] == 1
+    assert not scoped_new_response.json
+    assert list(long_response.json.keys()) == ['file1.txt']\
+           and long_response.json['file1.txt']['lines'][0]['line'] == 2
+    assert not long_mixed_response.json
+    assert unknown_commit_response.status_code == 404
+    assert BlobTerm.query.filter_by(blob_hash=shared_hash).count() == \
+           len(index_terms(tokenize(shared.decode())))
+
+    delete_response = client.delete(url_for('api.totaldelete',
+                                            token=search_token))
+    assert delete_response.status_code == 204
+    assert not BlobTerm.query.filter_by(blob_hash=shared_hash).count()
+
+
 def test_list(client):
     fine_response = client.get(url_for('api.list', token=token))
     assert fine_response.status_code == 200\
@@ -93,6 +180,7 @@ def test_commit_delete(client):
     commit_delete_response = \
         client.delete(url_for('api.delete', token=token, commit=commit))
     assert commit_delete_response.status_code == 204
+    assert recently_written(token)
 
 
 def test_token_delete(client):
@@ -0,0 +1,79 @@
+from werkzeug.datastructures import FileStorage
+from sqlalchemy import create_engine, event
+from flask import url_for, g
+from datetime import datetime, timedelta
+import io
+
+import app as geethub
+from app import (db, Token, generate_token, generate_user_token,
+                 generate_token_hash)
+
+
+def idle_token():
+    t, token = generate_token()
+    t.last_write_at = datetime.now() - timedelta(hours=1)
+    db.session.commit()
+    return t, token
+
+
+def test_read_uses_replica(client, replica):
+    t, token = idle_token()
+    response = client.get(url_for('api.list', token=token))
+    assert response.status_code == 404
+    assert replica
+
+
+def test_write_uses_primary(client, replica):
+    t, token = generate_token()
+    commit_response = client.post(url_for('api.commit', token=token), data={
+        'message': 'routing commit',
+        'file1': FileStorage(stream=io.BytesIO(b'routing'),
+                             filename='file1.txt')
+    }, content_type='multipart/form-data')
+    commit = client.get(url_for('api.list', token=token)).json
+    commit = [key for key in commit if key != 'current_size'][0]
+    t = Token.query.filter_by(token_hash=generate_token_hash(token)).first()
+    t.last_write_at = datetime.now() - timedelta(hours=1)
+    db.session.commit()
+    replica.clear()
+    post_response = client.post(url_for('checkout', token=token,
+                                        commit=commit))
+    assert commit_response.status_code == 201
+    assert post_response.status_code == 200
+    assert not replica
+    client.delete(url_for('api.totaldelete', token=token))
+
+
+def test_flush_uses_primary(app, replica):
+    with app.test_request_context():
+        g.replica = 'replica_0'
+        db.session.add(Token(token_hash=generate_token_hash(
+            generate_user_token(16))))
+        db.session.flush()
+        db.session.rollback()
+    assert not replica
+
+
+def test_recent_write_uses_primary(client, replica):
+    t, token = generate_token()
+    response = client.get(url_for('api.list', token=token))
+    assert response.status_code == 404
+    assert not replica
+
+
+def test_replica_error_falls_back(client, monkeypatch):
+    broken = create_engine('postgresql+psycopg2://geethub@127.0.0.1:1/'
+                           'geethub')
+    attempts = []
+    event.listen(broken, 'do_connect',
+                 lambda *args: attempts.append(args))
+    monkeypatch.setattr(geethub, 'replica_engines',
+                        lambda: {'replica_0': broken})
+    monkeypatch.setattr(geethub, 'replica_down_until', {})
+    t, token = idle_token()
+    response = client.get(url_for('api.list', token=token))
+    cooldown_response = client.get(url_for('api.list', token=token))
+    assert response.status_code == 404\
+           and response.json['message'] == 'Repository is empty!'
+    assert cooldown_response.status_code == 404
+    assert len(attempts) == 1